@@ -1,13 +1,30 @@
 from time import time
-from typing import Optional, Union, Tuple, List, Dict
-from os import path
+from typing import Optional, Union, Tuple, List, Dict, Sequence, Iterator
+from os import path, cpu_count, link, remove, replace
+from shutil import copyfile
 import torch
-from torch.utils.data import DataLoader, Dataset, SubsetRandomSampler
+from torch.amp import GradScaler, autocast
+from torch.utils.data import DataLoader, Dataset, SubsetRandomSampler, get_worker_info
+from torch.utils.data.dataloader import default_collate
 from torch.nn import Module
 from torch.optim import Optimizer
 from sklearn.model_selection import KFold
-import numpy as np
 from logging import Logger, getLogger, Formatter, FileHandler, StreamHandler, INFO
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import partial
+
+try:
+    from safetensors.torch import save_file, load_file
+except ImportError:
+    save_file = load_file = None
+
+# 输入尺寸固定时, 让cuDNN为每种卷积选择最快的算法; 在Ampere及更新的GPU上使用TF32进行矩阵乘法
+torch.backends.cudnn.benchmark = True
+torch.set_float32_matmul_precision("high")
+
+# 后台写入检查点的线程, 只使用一个线程以保证写入顺序
+_checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+_pending_checkpoints: List[Future] = []
 
 
 def get_train_info_logger(
@@ -37,9 +54,16 @@ def train_model(
     model_name: Optional[str] = None,
     epoches: int = 10,
     start_epoch: int = 0,
-    loss: Dict[str, list] = {"train": [], "val": []},
+    loss: Optional[Dict[str, list]] = None,
     best_val_loss: float = float("inf"),
     device: str = "cuda",
+    compile_mode: Optional[str] = "reduce-overhead",
+    use_amp: bool = True,
+    amp_dtype: torch.dtype = torch.bfloat16,
+    channels_last: bool = False,
+    grad_accum_steps: int = 1,
+    use_safetensors: bool = False,
+    log_every_n_batches: int = 50,
 ):
     """
     训练模型的函数。也可以重启训练。
@@ -55,96 +79,457 @@ def train_model(
     - epoches: 训练轮数,默认为10。
     - start_epoch: 从哪个轮数开始训练,默认为0。
     - loss: 存储训练和验证过程的损失值的字典,默认为空需要为以下形式: {"train": [], "val": []}。
+    - compile_mode: torch.compile 的编译模式,默认为"reduce-overhead",为None时不编译模型。
+    - use_amp: 是否使用混合精度训练,默认为True。
+    - amp_dtype: 混合精度训练使用的低精度类型,默认为torch.bfloat16。
+    - channels_last: 是否将模型和四维输入转换为channels_last内存格式,默认为False。
+      模型需要能处理不连续的卷积输出(如使用reshape而不是view展平)。
+    - grad_accum_steps: 梯度累积的批次数,每累积这么多个批次更新一次参数,默认为1。
+    - use_safetensors: 是否使用safetensors保存模型参数,默认为False,即保存为单个torch.save文件。
+      为True时检查点文件中不含模型参数,需要用load_checkpoints读取。
+    - log_every_n_batches: 每隔多少个批次记录一次当前批次的损失,为0时不记录,默认为50。
     """
+    if grad_accum_steps < 1:
+        raise ValueError(f"grad_accum_steps must be at least 1, got {grad_accum_steps}")
     # 如果未提供save_name,则使用模型的类名
     if model_name is None:
         model_name = type(training_model).__name__
+    # 每次调用使用新的字典, 避免多次训练共用默认参数
+    loss = loss if loss is not None else {"train": [], "val": []}
+    # 卷积在channels_last格式下可以使用更快的cuDNN实现, 需要在编译前转换
+    if channels_last:
+        channels_last = _to_channels_last(training_model, logger)
+    # 编译后的模型只用于训练, 检查点仍从原模型保存, 以便未编译的模型加载
+    compiled_model = _compile_model(training_model, compile_mode)
+    scaler = _make_grad_scaler(device, use_amp, amp_dtype)
 
     # 开始训练和验证过程
     for e in range(start_epoch, start_epoch + epoches):
         start_time = time()
+        # time()只统计主机端的耗时, GPU上的耗时用CUDA事件统计
+        start_event = _record_cuda_event(device)
         logger.info(f"Epoch {e} start")
         floss = train_single_fold(
-            training_model=training_model,
+            training_model=compiled_model,
             dloader=dloader,
             loss_func=loss_func,
             optimizer=optimizer,
             device=device,
             logger=logger,
+            use_amp=use_amp,
+            amp_dtype=amp_dtype,
+            scaler=scaler,
+            channels_last=channels_last,
+            grad_accum_steps=grad_accum_steps,
+            log_every_n_batches=log_every_n_batches,
         )
+        end_event = _record_cuda_event(device)
         loss["train"].append(floss[0])
         loss["val"].append(floss[1])
-        if loss["val"][-1] < best_val_loss:
+        is_best = loss["val"][-1] < best_val_loss
+        if is_best:
             best_val_loss = loss["val"][-1]
+        # 每轮只复制一次检查点, 供最佳模型和最新模型共用
+        checkpoint = make_checkpoint(
+            training_model=training_model,
+            optimizer=optimizer,
+            loss=loss,
+            e=e,
+            best_loss=best_val_loss,
+        )
+        if is_best:
             save_checkpoints(
-                training_model,
-                optimizer,
-                root_path,
-                model_name,
-                loss,
-                e=e,
+                checkpoint=checkpoint,
+                root_path=root_path,
+                model_name=model_name,
                 suffix="best",
-                best_loss=best_val_loss,
+                use_safetensors=use_safetensors,
+                logger=logger,
+            )
+            # 最新模型与最佳模型相同, 直接链接, 不再重复保存
+            link_checkpoints(
+                logger=logger,
+                root_path=root_path,
+                model_name=model_name,
+            )
+        else:
+            save_checkpoints(
+                checkpoint=checkpoint,
+                root_path=root_path,
+                model_name=model_name,
+                use_safetensors=use_safetensors,
                 logger=logger,
             )
-        save_checkpoints(
-            training_model,
-            optimizer,
-            root_path,
-            model_name,
-            loss,
-            e=e,
-            best_loss=best_val_loss,
-            logger=logger,
-        )
         end_time = time()
-        logger.info(f"Epoch {e} end with time {(end_time - start_time)/3600:.4f}")
+        logger.info(
+            f"Epoch {e} end with time {(end_time - start_time)/3600:.4f}"
+            f"{_format_cuda_time(start_event, end_event)}"
+        )
         logger.info("====================")
+    # 确保所有检查点都已写入磁盘
+    wait_checkpoints()
 
 
-def save_checkpoints(
+def make_checkpoint(
     training_model: Module,
     optimizer: Optimizer,
-    logger: Logger,
-    root_path: str,
-    model_name: str,
     loss: Dict[str, float],
     e: int,
     best_loss: float,
-    suffix: str = "latest",
-):
+) -> dict:
     """
-    保存训练模型的检查点。
+    构建训练模型的检查点。
 
-    此函数用于保存模型在特定训练阶段的状态,包括模型的参数、优化器的状态、当前的损失值和训练的轮次。
-    这使得模型能够在未来的某个时间点继续训练或者进行评估。
+    检查点包括当前训练轮次、模型状态字典、优化器状态字典和损失值, 其中的张量都被复制到CPU上,
+    因此之后训练继续修改参数也不会影响检查点的内容。同一个检查点可以多次传给 save_checkpoints。
 
     参数:
     - training_model (Module): 当前训练的模型。
     - optimizer (Optimizer): 当前使用的优化器。
-    - logger (Logger): 用于记录训练过程的日志记录器。
-    - root_path (str): 保存检查点的根目录路径。
-    - model_name (str): 模型的名称,用于生成保存文件的名称。
     - loss (Dict[str, float]): 当前模型的损失值,通常包括一个或多个损失项。
     - e (int): 当前训练的轮次
     - best_loss (float): 所有轮次里的最佳损失值
-    - suffix (str): 模型的训练轮次或者标识,用于生成保存文件的名称,默认为"latest"。
-    """
-    # 生成保存模型检查点的完整路径
-    save_path = path.join(root_path, f"{model_name}_{suffix}.ckpt")
 
-    # 保存模型检查点,包括当前训练轮次、模型状态字典、优化器状态字典和损失值
-    torch.save(
+    返回:
+    - 检查点字典。
+    """
+    # 等待上一次写入完成, 同时只保留一份CPU上的副本
+    wait_checkpoints()
+    return _to_cpu(
         {
             "epoch": e,
             "model_state_dict": training_model.state_dict(),
             "optimizer_state_dict": optimizer.state_dict(),
             "loss": loss,
-            "best_loss":best_loss
-        },
-        save_path,
+            "best_loss": best_loss,
+        }
+    )
+
+
+def save_checkpoints(
+    checkpoint: dict,
+    logger: Logger,
+    root_path: str,
+    model_name: str,
+    suffix: str = "latest",
+    use_safetensors: bool = False,
+):
+    """
+    保存训练模型的检查点。
+
+    此函数用于保存模型在特定训练阶段的状态,包括模型的参数、优化器的状态、当前的损失值和训练的轮次。
+    这使得模型能够在未来的某个时间点继续训练或者进行评估。
+
+    检查点交给后台线程按顺序写入磁盘, 因此函数返回时文件可能尚未写完。
+    需要确保文件已写入时, 调用 wait_checkpoints。
+
+    使用safetensors时, 模型参数保存在 <model_name>_<suffix>.safetensors 中,
+    其余内容仍保存在 <model_name>_<suffix>.ckpt 中。两种格式都可以用 load_checkpoints 读取。
+
+    参数:
+    - checkpoint (dict): 由 make_checkpoint 构建的检查点。
+    - logger (Logger): 用于记录训练过程的日志记录器。
+    - root_path (str): 保存检查点的根目录路径。
+    - model_name (str): 模型的名称,用于生成保存文件的名称。
+    - suffix (str): 模型的训练轮次或者标识,用于生成保存文件的名称,默认为"latest"。
+    - use_safetensors (bool): 是否使用safetensors保存模型参数,默认为False。
+    """
+    if use_safetensors and save_file is None:
+        raise ImportError("safetensors is required when use_safetensors is True")
+
+    # 生成保存模型检查点的完整路径, 不含扩展名
+    save_path = path.join(root_path, f"{model_name}_{suffix}")
+
+    _pending_checkpoints.append(
+        _checkpoint_executor.submit(
+            _write_checkpoint, checkpoint, save_path, suffix, logger, use_safetensors
+        )
     )
-    logger.info(f"Save {suffix} model to {save_path}")
+
+
+def load_checkpoints(root_path: str, model_name: str, suffix: str = "latest") -> dict:
+    """
+    读取由 save_checkpoints 保存的检查点。
+
+    参数:
+    - root_path (str): 保存检查点的根目录路径。
+    - model_name (str): 模型的名称,用于生成保存文件的名称。
+    - suffix (str): 模型的训练轮次或者标识,用于生成保存文件的名称,默认为"latest"。
+
+    返回:
+    - 检查点字典,包括"epoch"、"model_state_dict"、"optimizer_state_dict"、"loss"和"best_loss"。
+    """
+    save_path = path.join(root_path, f"{model_name}_{suffix}")
+    checkpoint = torch.load(f"{save_path}.ckpt")
+    # 模型参数单独保存在safetensors文件中
+    if "model_state_dict" not in checkpoint:
+        if load_file is None:
+            raise ImportError(f"safetensors is required to load {save_path}.safetensors")
+        checkpoint["model_state_dict"] = load_file(f"{save_path}.safetensors")
+    return checkpoint
+
+
+def link_checkpoints(
+    logger: Logger,
+    root_path: str,
+    model_name: str,
+    src_suffix: str = "best",
+    dst_suffix: str = "latest",
+):
+    """
+    将已保存的检查点链接为另一个标识的检查点, 避免重复保存相同的内容。
+
+    链接在后台线程中排在之前的写入之后执行。文件系统不支持硬链接时, 退回到复制文件。
+
+    参数:
+    - logger (Logger): 用于记录训练过程的日志记录器。
+    - root_path (str): 保存检查点的根目录路径。
+    - model_name (str): 模型的名称,用于生成保存文件的名称。
+    - src_suffix (str): 已保存检查点的标识,默认为"best"。
+    - dst_suffix (str): 链接得到的检查点的标识,默认为"latest"。
+    """
+    src_path = path.join(root_path, f"{model_name}_{src_suffix}")
+    dst_path = path.join(root_path, f"{model_name}_{dst_suffix}")
+    _pending_checkpoints.append(
+        _checkpoint_executor.submit(
+            _link_checkpoint, src_path, dst_path, dst_suffix, logger
+        )
+    )
+
+
+def wait_checkpoints():
+    """
+    等待后台的检查点写入完成。写入过程中出现的异常会在此处抛出。
+    """
+    while _pending_checkpoints:
+        _pending_checkpoints.pop(0).result()
+
+
+def _write_checkpoint(
+    checkpoint: dict,
+    save_path: str,
+    suffix: str,
+    logger: Logger,
+    use_safetensors: bool,
+):
+    # 先写入临时文件再替换, 不会改动与其他检查点共享的硬链接文件
+    if use_safetensors:
+        # safetensors 只能保存连续的张量, channels_last 格式的参数需要先转换
+        model_state_dict = {
+            k: v.contiguous() for k, v in checkpoint["model_state_dict"].items()
+        }
+        save_file(model_state_dict, f"{save_path}.safetensors.tmp")
+        replace(f"{save_path}.safetensors.tmp", f"{save_path}.safetensors")
+        checkpoint = {k: v for k, v in checkpoint.items() if k != "model_state_dict"}
+    torch.save(checkpoint, f"{save_path}.ckpt.tmp")
+    replace(f"{save_path}.ckpt.tmp", f"{save_path}.ckpt")
+    logger.info(f"Save {suffix} model to {save_path}.ckpt")
+
+
+def _link_checkpoint(src_path: str, dst_path: str, suffix: str, logger: Logger):
+    for ext in [".ckpt", ".safetensors"]:
+        if not path.exists(f"{src_path}{ext}"):
+            continue
+        tmp_path = f"{dst_path}{ext}.tmp"
+        if path.exists(tmp_path):
+            remove(tmp_path)
+        try:
+            link(f"{src_path}{ext}", tmp_path)
+        except OSError:
+            copyfile(f"{src_path}{ext}", tmp_path)
+        replace(tmp_path, f"{dst_path}{ext}")
+    logger.info(f"Link {suffix} model to {src_path}.ckpt")
+
+
+def _to_cpu(obj):
+    """
+    递归地复制对象中的张量到CPU上, 字典、列表和元组也会被复制。
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def _record_cuda_event(device: str) -> Optional[torch.cuda.Event]:
+    # 在设备的当前流上记录可计时的事件, 非CUDA设备返回None
+    if torch.device(device).type != "cuda":
+        return None
+    event = torch.cuda.Event(enable_timing=True)
+    event.record(torch.cuda.current_stream(device))
+    return event
+
+
+def _format_cuda_time(
+    start_event: Optional[torch.cuda.Event], end_event: Optional[torch.cuda.Event]
+) -> str:
+    # 只等待结束事件完成, 而不是同步整个设备
+    if start_event is None or end_event is None:
+        return ""
+    end_event.synchronize()
+    return f" (GPU {start_event.elapsed_time(end_event)/1000/3600:.4f} hours)"
+
+
+def _to_channels_last(training_model: Module, logger: Logger) -> bool:
+    # 含有五维参数(如Conv3d)的模型不能转换为channels_last格式, 此时保持原格式
+    tensors = list(training_model.parameters()) + list(training_model.buffers())
+    if any(t.dim() == 5 for t in tensors):
+        logger.warning("Model has 5-D parameters, channels_last is disabled")
+        return False
+    training_model.to(memory_format=torch.channels_last)
+    return True
+
+
+def _compile_model(training_model: Module, compile_mode: Optional[str]) -> Module:
+    if compile_mode is None:
+        return training_model
+    return torch.compile(training_model, mode=compile_mode, fullgraph=False)
+
+
+def _make_grad_scaler(
+    device: str, use_amp: bool, amp_dtype: torch.dtype
+) -> GradScaler:
+    # bfloat16 与 float32 的数值范围相同, 只有 float16 需要缩放梯度以避免下溢
+    return GradScaler(
+        torch.device(device).type, enabled=use_amp and amp_dtype == torch.float16
+    )
+
+
+class StagedBatch:
+    """
+    按数据类型打包的批次。
+
+    同一数据类型的张量存放在一段连续的缓冲区中, 移动到设备时每种数据类型只需拷贝一次,
+    而不是每个张量各拷贝一次。由 staged_collate 生成。
+
+    参数:
+    - buffers: 数据类型到一维缓冲区的字典。
+    - layout: 每个张量在缓冲区中的位置, 为 (数据类型, 起始位置, 形状) 的列表。
+    """
+
+    def __init__(
+        self,
+        buffers: Dict[torch.dtype, torch.Tensor],
+        layout: List[Tuple[torch.dtype, int, torch.Size]],
+    ):
+        self.buffers = buffers
+        self.layout = layout
+
+    def pin_memory(self) -> "StagedBatch":
+        """
+        将缓冲区放入页锁定内存。DataLoader 的 pin_memory=True 时会自动调用。
+        """
+        return StagedBatch(
+            {dtype: buf.pin_memory() for dtype, buf in self.buffers.items()},
+            self.layout,
+        )
+
+    def to(self, device: str, non_blocking: bool = False) -> List[torch.Tensor]:
+        """
+        将缓冲区移动到指定设备, 并返回批次中各张量在设备上的视图。
+        """
+        buffers = {
+            dtype: buf.to(device, non_blocking=non_blocking)
+            for dtype, buf in self.buffers.items()
+        }
+        return [
+            buffers[dtype][offset : offset + shape.numel()].view(shape)
+            for dtype, offset, shape in self.layout
+        ]
+
+
+def staged_collate(samples: Sequence[Sequence[torch.Tensor]]):
+    """
+    将样本整理为 StagedBatch 的 collate_fn。
+
+    每个样本需要为张量组成的元组或列表, 如 (输入1, 输入2, ..., 目标)。
+    其他形式的样本交由 default_collate 处理。
+    """
+    if not isinstance(samples[0], (tuple, list)) or not all(
+        torch.is_tensor(item) for item in samples[0]
+    ):
+        return default_collate(samples)
+
+    fields = list(zip(*samples))
+    layout = []
+    numel = {}
+    elems = {}
+    for field in fields:
+        dtype = field[0].dtype
+        elems.setdefault(dtype, field[0])
+        shape = torch.Size((len(field), *field[0].shape))
+        offset = numel.get(dtype, 0)
+        layout.append((dtype, offset, shape))
+        numel[dtype] = offset + shape.numel()
+
+    buffers = {}
+    for dtype, n in numel.items():
+        if get_worker_info() is not None:
+            # 在子进程中直接在共享内存中分配, 避免传回主进程时再复制一次
+            storage = elems[dtype]._typed_storage()._new_shared(n, device="cpu")
+            buffers[dtype] = elems[dtype].new(storage)
+        else:
+            buffers[dtype] = torch.empty(n, dtype=dtype)
+
+    # 直接将样本堆叠到缓冲区中
+    for field, (dtype, offset, shape) in zip(fields, layout):
+        torch.stack(
+            field, out=buffers[dtype][offset : offset + shape.numel()].view(shape)
+        )
+    return StagedBatch(buffers, layout)
+
+
+def _batch_to_device(
+    batch, device: str, channels_last: bool = False
+) -> List[torch.Tensor]:
+    # 配合DataLoader的pin_memory, 使用非阻塞拷贝与计算重叠
+    if isinstance(batch, StagedBatch):
+        batch = batch.to(device, non_blocking=True)
+    else:
+        batch = [item.to(device, non_blocking=True) for item in batch]
+    if channels_last:
+        batch = [
+            item.to(memory_format=torch.channels_last) if item.dim() == 4 else item
+            for item in batch
+        ]
+    return batch
+
+
+def _prefetch_to_device(
+    loader: DataLoader, device: str, channels_last: bool = False
+) -> Iterator[List[torch.Tensor]]:
+    """
+    遍历数据加载器, 并将批次移动到指定设备。
+
+    使用CUDA时, 下一个批次在单独的流上拷贝, 与当前批次的计算(包括优化器的更新)重叠。
+    """
+    if torch.device(device).type != "cuda":
+        for batch in loader:
+            yield _batch_to_device(batch, device, channels_last)
+        return
+
+    copy_stream = torch.cuda.Stream(device)
+    main_stream = torch.cuda.current_stream(device)
+
+    def stage(batch):
+        with torch.cuda.stream(copy_stream):
+            return _batch_to_device(batch, device, channels_last)
+
+    next_batch = None
+    for batch in loader:
+        staged = stage(batch)
+        if next_batch is not None:
+            yield next_batch
+        # 主流等待拷贝完成后才使用该批次; 同时告知缓存分配器该批次在主流上使用
+        main_stream.wait_stream(copy_stream)
+        for item in staged:
+            item.record_stream(main_stream)
+        next_batch = staged
+    if next_batch is not None:
+        yield next_batch
 
 
 def train_single_fold(
@@ -154,6 +539,12 @@ def train_single_fold(
     optimizer: Optimizer,
     logger: Logger,
     device: str = "cuda",
+    use_amp: bool = True,
+    amp_dtype: torch.dtype = torch.bfloat16,
+    scaler: Optional[GradScaler] = None,
+    channels_last: bool = False,
+    grad_accum_steps: int = 1,
+    log_every_n_batches: int = 50,
 ) -> float:
     """
     训练模型的函数。也可以重启训练。
@@ -165,16 +556,27 @@ def train_single_fold(
     - optimizer: 优化器。
     - logger: 用于记录训练进度的日志记录器。
     - device: 用于训练的设备。默认为 "cuda"。
+    - use_amp: 是否使用混合精度训练。默认为 True。
+    - amp_dtype: 混合精度训练使用的低精度类型。默认为 torch.bfloat16。
+    - scaler: 梯度缩放器。默认为 None, 即根据 use_amp 和 amp_dtype 新建一个, 只有 torch.float16 会缩放梯度。
+    - channels_last: 是否将四维输入转换为 channels_last 内存格式, 需要与模型的格式一致。默认为 False。
+    - grad_accum_steps: 梯度累积的批次数, 每累积这么多个批次更新一次参数。默认为 1。
+    - log_every_n_batches: 每隔多少个批次记录一次当前批次的损失, 为 0 时不记录。默认为 50。
     """
-    # 计算训练和验证数据集的大小
-    dset_size = {s: len(dset) for s, dset in dloader.items() if s in ["train", "val"]}
-
+    if grad_accum_steps < 1:
+        raise ValueError(f"grad_accum_steps must be at least 1, got {grad_accum_steps}")
+    device_type = torch.device(device).type
+    if scaler is None:
+        scaler = _make_grad_scaler(device, use_amp, amp_dtype)
     # 开始训练和验证过程
     loss = []
     # 对于每个epoch,分别处理训练和验证数据集
     for dataset in ["train", "val"]:
         logger.info(f"{dataset} start")
-        loss_epoch = 0
+        # 在设备上累加损失, 避免每个批次都同步一次
+        loss_epoch = torch.zeros((), device=device)
+        # 已处理的样本数, 用于计算平均损失
+        num_samples = 0
 
         # 根据数据集设置模型的训练/评估模式
         if dataset == "train":
@@ -183,29 +585,51 @@ def train_single_fold(
             training_model.eval()
 
         # 遍历数据集中的所有数据
-        for batch in dloader[dataset]:
-            optimizer.zero_grad()
-
-            # 将数据移动到指定设备
-            batch = [item.to(device) for item in batch]
+        num_batches = len(dloader[dataset])
+        # 在后台预取下一个批次到指定设备
+        batches = _prefetch_to_device(dloader[dataset], device, channels_last)
+        for step, batch in enumerate(batches):
             targets = batch[-1]
 
-            # 根据当前是否在训练阶段, 决定是否启用梯度计算
-            with torch.set_grad_enabled(dataset == "train"):
-                outputs = training_model(*batch[0:-1])
-                current_loss = loss_func(outputs, targets)
-
-                # 在训练阶段,执行反向传播和优化步骤
-                if dataset == "train":
-                    current_loss.backward()
-                    optimizer.step()
+            if dataset == "train":
+                # 在训练阶段,执行前向传播、反向传播和优化步骤
+                # 梯度在显存中累积, 每grad_accum_steps个批次更新一次参数
+                if step % grad_accum_steps == 0:
+                    optimizer.zero_grad(set_to_none=True)
+                    # 最后一组可能不足grad_accum_steps个批次, 按实际的批次数求平均
+                    group_size = min(grad_accum_steps, num_batches - step)
+                with autocast(device_type, dtype=amp_dtype, enabled=use_amp):
+                    outputs = training_model(*batch[0:-1])
+                    current_loss = loss_func(outputs, targets)
+                # 缩放损失, 使累积的梯度为各批次梯度的平均值
+                scaler.scale(current_loss / group_size).backward()
+                if (step + 1) % grad_accum_steps == 0 or step + 1 == num_batches:
+                    scaler.step(optimizer)
+                    scaler.update()
+            else:
+                # 在验证阶段,使用推理模式, 不记录任何自动求导信息
+                with torch.inference_mode(), autocast(
+                    device_type, dtype=amp_dtype, enabled=use_amp
+                ):
+                    outputs = training_model(*batch[0:-1])
+                    current_loss = loss_func(outputs, targets)
 
             # 累加当前批次的损失值
             # logger.info(f"{dataset} outputs: {outputs}")
-            loss_epoch += current_loss.item() * batch[0].size(0)
+            loss_epoch += current_loss.detach() * batch[0].size(0)
+            num_samples += batch[0].size(0)
+            # 每隔若干批次记录一次损失, 只在记录时同步
+            if (
+                log_every_n_batches > 0
+                and step % log_every_n_batches == 0
+                and logger.isEnabledFor(INFO)
+            ):
+                logger.info(f"{dataset} batch {step} loss {current_loss.item():.4f}")
+        # 每个阶段只在结束时同步一次
+        loss_epoch = loss_epoch.item()
         logger.info(f"{dataset} batch end with loss {loss_epoch:.4f}")
         # 计算并存储当前阶段的平均损失值
-        loss.append(loss_epoch / dset_size[dataset])
+        loss.append(loss_epoch / num_samples)
         logger.info(f"{dataset} end with loss {loss[-1]:.4f}")
 
     return loss
@@ -224,13 +648,23 @@ def cross_validate(
     root_path: str = ".",
     single_fold_func: callable = train_single_fold,
     prefix: Optional[str] = None,
-    loss: Dict[str, float] = {"mean": [], "std": []},
+    loss: Optional[Dict[str, list]] = None,
     best_loss: float = float("inf"),
     device: str = "cuda",
+    num_workers: Optional[int] = None,
+    compile_mode: Optional[str] = "reduce-overhead",
+    use_amp: bool = True,
+    amp_dtype: torch.dtype = torch.bfloat16,
+    channels_last: bool = False,
+    grad_accum_steps: int = 1,
+    use_safetensors: bool = False,
+    log_every_n_batches: int = 50,
 ):
     """
     对给定的数据集进行交叉验证训练和评估。
 
+    每轮中各折按顺序训练同一个模型, 后一折接着前一折的模型状态继续训练。
+
     参数:
     - dataset: Dataset 实例,包含所有训练和验证数据。
     - training_model: Module 实例,待训练的模型。
@@ -242,46 +676,95 @@ def cross_validate(
     - epoches: int,默认为10,表示训练的轮数。
     - start_epoches: int,默认为0,表示开始训练的轮数。
     - root_path: str,默认为".",表示保存模型和结果的根路径。
+    - single_fold_func: callable,默认为train_single_fold,表示训练单个折的函数。
+      use_amp、amp_dtype、channels_last、grad_accum_steps和log_every_n_batches只对默认的train_single_fold生效,
+      自定义的函数收到的批次与DataLoader默认整理的批次相同。
     - model_name: Optional[str],模型的名称,如未提供,则使用模型的类名。
-    - loss: Dict[str, float],用于存储每轮训练的损失均值和标准差。
+    - loss: Optional[Dict[str, list]],用于存储每轮训练的损失均值和标准差,默认为空需要为以下形式: {"mean": [], "std": []}。
     - best_loss: float, 用于存储最佳损失。
     - device: str,默认为"cuda",表示设备类型。
+    - num_workers: Optional[int],训练和验证数据加载器各自的子进程数,默认为min(4, CPU核数),为0时在主进程中加载。
+      各折共用同一对数据加载器,共2*num_workers个子进程,在第一次遍历时创建,之后在各折和各轮之间保留。
+    - compile_mode: Optional[str],torch.compile 的编译模式,默认为"reduce-overhead",为None时不编译模型。
+    - use_amp: bool,默认为True,表示是否使用混合精度训练。
+    - amp_dtype: torch.dtype,默认为torch.bfloat16,表示混合精度训练使用的低精度类型。
+    - channels_last: bool,默认为False,表示是否将模型和四维输入转换为channels_last内存格式。
+      模型需要能处理不连续的卷积输出(如使用reshape而不是view展平)。
+    - grad_accum_steps: int,默认为1,表示梯度累积的批次数,每累积这么多个批次更新一次参数。
+    - use_safetensors: bool,默认为False,表示是否使用safetensors保存模型参数,为False时保存为单个torch.save文件。
+      为True时检查点文件中不含模型参数,需要用load_checkpoints读取。
+    - log_every_n_batches: int,默认为50,表示每隔多少个批次记录一次当前批次的损失,为0时不记录。
     """
+    if grad_accum_steps < 1:
+        raise ValueError(f"grad_accum_steps must be at least 1, got {grad_accum_steps}")
     # 如果未提供save_name,则使用模型的类名
     if prefix is None:
         prefix = type(training_model).__name__
+    # 每次调用使用新的字典, 避免多次训练共用默认参数
+    loss = loss if loss is not None else {"mean": [], "std": []}
+    # 卷积在channels_last格式下可以使用更快的cuDNN实现, 需要在编译前转换
+    if channels_last:
+        channels_last = _to_channels_last(training_model, logger)
+    # 编译后的模型只用于训练, 检查点仍从原模型保存, 以便未编译的模型加载
+    compiled_model = _compile_model(training_model, compile_mode)
+    # 混合精度等选项和打包的批次只用于默认的 train_single_fold, 自定义的 single_fold_func 保持原有的参数和批次形式
+    use_default_fold = single_fold_func is train_single_fold
+    if use_default_fold:
+        single_fold_func = partial(
+            train_single_fold,
+            use_amp=use_amp,
+            amp_dtype=amp_dtype,
+            scaler=_make_grad_scaler(device, use_amp, amp_dtype),
+            channels_last=channels_last,
+            grad_accum_steps=grad_accum_steps,
+            log_every_n_batches=log_every_n_batches,
+        )
     # 初始化KFold对象进行交叉验证分割
     kf = KFold(n_splits=n_splits, shuffle=True, random_state=42)
-    # 初始化最佳损失为无穷大
-    dloader = []
-    for train_idx, val_idx in kf.split(dataset):
-        dloader.append(
-            {
-                "train": DataLoader(
-                    dataset,
-                    batch_size=batch_size,
-                    sampler=SubsetRandomSampler(train_idx),
-                ),
-                "val": DataLoader(
-                    dataset,
-                    batch_size=batch_size,
-                    sampler=SubsetRandomSampler(val_idx),
-                ),
-            }
-        )
+    # 使用CUDA时将数据放在页锁定内存中, 以便异步拷贝到显存
+    pin_memory = torch.device(device).type == "cuda"
+    # 使用多个子进程预取数据, 并在各折和各轮之间保留子进程
+    # persistent_workers 使 DataLoader 缓存自身的迭代器, 之后每次遍历只重置采样器, 不再重新创建子进程
+    if num_workers is None:
+        num_workers = min(4, cpu_count() or 1)
+    loader_kwargs = {
+        "batch_size": batch_size,
+        "pin_memory": pin_memory,
+        "num_workers": num_workers,
+        "persistent_workers": num_workers > 0,
+    }
+    if use_default_fold:
+        # 将每个批次打包到连续的缓冲区中, 减少拷贝到设备的次数
+        loader_kwargs["collate_fn"] = staged_collate
+    folds = list(kf.split(dataset))
+    # 各折只切换采样器的索引, 共用同一对数据加载器及其子进程
+    # 采样器在主进程中生成索引, 每次遍历开始时才读取, 因此可以在两次遍历之间修改
+    sampler = {
+        "train": SubsetRandomSampler(folds[0][0]),
+        "val": SubsetRandomSampler(folds[0][1]),
+    }
+    dloader = {
+        s: DataLoader(dataset, sampler=sampler[s], **loader_kwargs)
+        for s in ["train", "val"]
+    }
     # 遍历每个epoch
     for e in range(start_epoches, start_epoches + epoches):
         start_time = time()
+        # time()只统计主机端的耗时, GPU上的耗时用CUDA事件统计
+        start_event = _record_cuda_event(device)
         logger.info(f"Epoch {e} start")
         fold_loss = []
         # 遍历每个交叉验证折
-        for fold in range(n_splits):
+        # 各折共享同一个模型和优化器, 依次在上一折的基础上继续训练, 因此不能拆分到多个进程/GPU上并行
+        for fold, (train_idx, val_idx) in enumerate(folds):
             logger.info(f"Fold {fold} start")
-            # 创建训练和验证的数据加载器
+            # 切换训练和验证的数据加载器到当前折
+            sampler["train"].indices = train_idx
+            sampler["val"].indices = val_idx
             # 训练单个折并获取损失
             floss = single_fold_func(
-                training_model=training_model,
-                dloader=dloader[fold],
+                training_model=compiled_model,
+                dloader=dloader,
                 loss_func=loss_func,
                 optimizer=optim,
                 device=device,
@@ -289,38 +772,53 @@ def cross_validate(
             )
             fold_loss.append(floss[-1])
             logger.info(f"Fold {fold} end")
+        end_event = _record_cuda_event(device)
         # 计算当前epoch的损失均值和标准差
-        fold_loss_mean = np.mean(fold_loss)
-        fold_loss_std = np.std(fold_loss)
+        # 与np.mean和np.std一致, 使用float64计算总体标准差
+        fold_loss = torch.tensor(fold_loss, dtype=torch.float64)
+        fold_loss_mean = fold_loss.mean().item()
+        fold_loss_std = fold_loss.std(correction=0).item()
         loss["mean"].append(fold_loss_mean)
         loss["std"].append(fold_loss_std)
         end_time = time()
         logger.info(
-            f"End epoch {e} with {n_splits} folds in {(end_time-start_time)/3600:.4f} hours with loss {fold_loss_mean:.4f} +/- {fold_loss_std:.4f}"
+            f"End epoch {e} with {n_splits} folds in {(end_time-start_time)/3600:.4f} hours{_format_cuda_time(start_event, end_event)} with loss {fold_loss_mean:.4f} +/- {fold_loss_std:.4f}"
         )
         # 如果当前损失均值为最佳,则保存模型
-        if fold_loss_mean < best_loss:
+        is_best = fold_loss_mean < best_loss
+        if is_best:
             best_loss = fold_loss_mean
+        # 每轮只复制一次检查点, 供最佳模型和最新模型共用
+        checkpoint = make_checkpoint(
+            training_model=training_model,
+            optimizer=optim,
+            loss=loss,
+            e=e,
+            best_loss=best_loss,
+        )
+        if is_best:
             save_checkpoints(
-                training_model=training_model,
-                optimizer=optim,
+                checkpoint=checkpoint,
                 model_name=prefix,
                 root_path=root_path,
-                loss=loss,
-                e=e,
                 suffix="best",
-                best_loss=best_loss,
+                use_safetensors=use_safetensors,
                 logger=logger,
             )
-
-        # 保存最新模型
-        save_checkpoints(
-            training_model=training_model,
-            optimizer=optim,
-            model_name=prefix,
-            root_path=root_path,
-            e=e,
-            loss=loss,
-            best_loss=best_loss,
-            logger=logger,
-        )
+            # 最新模型与最佳模型相同, 直接链接, 不再重复保存
+            link_checkpoints(
+                logger=logger,
+                root_path=root_path,
+                model_name=prefix,
+            )
+        else:
+            # 保存最新模型
+            save_checkpoints(
+                checkpoint=checkpoint,
+                model_name=prefix,
+                root_path=root_path,
+                use_safetensors=use_safetensors,
+                logger=logger,
+            )
+    # 确保所有检查点都已写入磁盘
+    wait_checkpoints()
@@ -22,7 +22,11 @@ from util.model.surf.modified_cnn_model import (
 from util.model.surf.pretrained_model import PretrainedModelDb
 from util.model.surf.dateset import SurfDatasetFromMat
 
-from util.train.torch.iteration import cross_validate, get_train_info_logger
+from util.train.torch.iteration import (
+    cross_validate,
+    get_train_info_logger,
+    load_checkpoints,
+)
 from torch import optim
 
 from typing import Dict, Union, Any
@@ -77,11 +81,7 @@ def start_train(
 
     # 根据train_type加载模型和优化器的状态
     if not train_type == "start":
-        checkpoint_path = os.path.join(
-            save_root_path,
-            f"{prefix}_{train_type}.ckpt",
-        )
-        checkpoint = torch.load(checkpoint_path)
+        checkpoint = load_checkpoints(save_root_path, prefix, train_type)
         train_model.load_state_dict(checkpoint["model_state_dict"])
         optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
         kwds = {